@@ -6,7 +6,7 @@
 # - Uses .env next to this file or Streamlit Secrets on cloud
 #
 # Quickstart (local):
-#   pip install streamlit pandas stripe python-dotenv
+#   pip install "streamlit>=1.37" pandas stripe python-dotenv
 #   streamlit run app_streamlit.py --server.port 8502
 #
 # Required secrets / env:
@@ -14,21 +14,31 @@
 #   PUBLIC_BASE_URL   = http://127.0.0.1:8502  (or your https streamlit.app url)
 
 from __future__ import annotations
+import io
 import json
+import math
 import os
 import sqlite3
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, time, timedelta, timezone
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, ContextManager, List, Mapping, Optional, Tuple
 
 import hashlib
+from html import escape
 from urllib.parse import urlsplit, urlunsplit
 
 import pandas as pd
 import streamlit as st
 from streamlit.components.v1 import html as st_html
 from dotenv import load_dotenv
-import stripe
+
+from db import Database
+
+try:  # optional: much faster JSON parse/encode, stdlib json is the fallback
+    import orjson
+except ImportError:
+    orjson = None
 
 # ---------- Paths / .env ----------
 APP_DIR = Path(__file__).resolve().parent
@@ -42,6 +52,7 @@ DEFAULT_TAX_RATE = 0.085
 DEFAULT_DELIVERY_FEE = 3.00
 MENU_FILE = str(APP_DIR / "menu.json")
 DB_FILE = str(APP_DIR / "orders.db")
+DB_READERS = 5
 
 # ---------- Secrets / ENV helpers ----------
 
@@ -63,15 +74,31 @@ def _clean_base_url(url: str) -> str:
         return url.rstrip("/")
     return urlunsplit((parts.scheme, parts.netloc, "", "", "")).rstrip("/")
 
-# Stripe globals
+# Stripe globals (the SDK itself is imported on first use, see _stripe())
 STRIPE_ENABLED = True
-stripe.api_key = _get_secret_env("STRIPE_SECRET_KEY", "")
+STRIPE_SECRET_KEY = _get_secret_env("STRIPE_SECRET_KEY", "")
 PUBLIC_BASE_URL = _clean_base_url(_get_secret_env("PUBLIC_BASE_URL", "http://127.0.0.1:8502"))
+CHECKOUT_REUSE_MARGIN = 600  # seconds: don't hand out a stored session this close to expiring
+# Checkout return URLs; Stripe fills in {CHECKOUT_SESSION_ID} itself
+SUCCESS_TEMPLATE = PUBLIC_BASE_URL + "?checkout=success&order_id={oid}&session_id={{CHECKOUT_SESSION_ID}}"
+CANCEL_TEMPLATE = PUBLIC_BASE_URL + "?checkout=canceled&order_id={oid}"
 
 STATUS_CHOICES = ["new", "in_progress", "ready", "completed"]
 SERVICE_TYPES = ["Dine-In", "Takeout", "Delivery"]
 PAYMENT_METHODS = ["Card (Stripe)"]
 
+
+def _stripe():
+    """The Stripe SDK, imported on first use so the KDS/Manager paths skip its
+    import cost (requests, urllib3, ssl, ...). The key follows env/secrets."""
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+
+def stripe_ready() -> bool:
+    return STRIPE_ENABLED and bool(STRIPE_SECRET_KEY)
+
 # ---------- Utilities ----------
 
 def money(x: float) -> str:
@@ -81,6 +108,37 @@ def money(x: float) -> str:
         return f"{CURRENCY}{x}"
 
 
+def _json_loads(text):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def _json_dumps(obj: Any) -> str:
+    # Compact, non-ASCII kept as-is (same as json.dumps(..., ensure_ascii=False))
+    return orjson.dumps(obj).decode("utf-8") if orjson is not None else json.dumps(obj, ensure_ascii=False)
+
+
+def _json_dump_bytes(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def write_file_atomic(path: str, data: bytes) -> None:
+    # Readers see either the old file or the new one, never a partial write.
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def utc_day_range(day_from: date, day_to: date) -> Tuple[str, str]:
+    """Local calendar days [day_from, day_to] as a half-open range of UTC
+    timestamps in SQLite's CURRENT_TIMESTAMP format."""
+    start = datetime.combine(day_from, time.min).astimezone(timezone.utc)
+    end = datetime.combine(day_to + timedelta(days=1), time.min).astimezone(timezone.utc)
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+
+
 def ensure_menu_file(path: str = MENU_FILE) -> None:
     if os.path.exists(path):
         return
@@ -156,23 +214,162 @@ def ensure_menu_file(path: str = MENU_FILE) -> None:
             },
         ]
     }
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(default_menu, f, indent=2)
+    write_file_atomic(path, _json_dump_bytes(default_menu))
 
 
-def load_menu(path: str = MENU_FILE) -> Dict[str, Any]:
-    ensure_menu_file(path)
+@st.cache_data(ttl=300, show_spinner=False)
+def _read_menu_text(path: str, mtime: float) -> str:
+    # Raw menu.json text, for the parser below and the Admin editor
     with open(path, "r", encoding="utf-8-sig") as f:
-        return json.load(f)
+        return f.read()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_menu_cached(path: str, mtime: float) -> Dict[str, Any]:
+    # mtime is part of the cache key, so editing menu.json invalidates automatically;
+    # the ttl just lets entries for superseded mtimes age out.
+    menu = _json_loads(_read_menu_text(path, mtime))
+    index_menu(menu)
+    return menu
+
+
+def index_menu(menu: Dict[str, Any]) -> None:
+    """Attach lookup tables so pricing is dict lookups instead of nested scans."""
+    index = {}
+    for cat in menu.get("categories", []):
+        for it in cat.get("items", []):
+            it["_size_delta"] = {s["name"]: float(s.get("price_delta", 0)) for s in it.get("sizes") or []}
+            it["_topping_delta"] = {m["name"]: float(m.get("price_delta", 0)) for m in it.get("available_toppings") or []}
+            index[it.get("id")] = it
+    menu["_index"] = index
 
-# ---------- Database ----------
 
-def get_conn():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+def load_menu(path: str = MENU_FILE) -> Dict[str, Any]:
+    # The mtime stat doubles as the existence check: one syscall per rerun
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        ensure_menu_file(path)
+        mtime = os.path.getmtime(path)
+    return _load_menu_cached(path, mtime)
 
 
-def init_db():
-    con = get_conn(); cur = con.cursor()
+def save_menu(menu: Dict[str, Any], path: str = MENU_FILE) -> None:
+    write_file_atomic(path, _json_dump_bytes(menu))
+    _read_menu_text.clear(); _load_menu_cached.clear()
+
+# ---------- Database ----------
+
+# Hot statements as fixed text so the per-connection statement cache reuses them.
+# created_at is stamped by SQLite (UTC, "YYYY-MM-DD HH:MM:SS"); it is spelled out
+# because databases created before the column DEFAULT existed can't be altered.
+SQL_INSERT_ORDER = """
+INSERT INTO orders (
+    created_at, customer_name, customer_phone, service_type, table_number,
+    status, paid, payment_method, notes, source,
+    subtotal, tax, discount, delivery_fee, tip, total
+) VALUES (CURRENT_TIMESTAMP,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+SQL_INSERT_ITEM = """
+INSERT INTO order_items (
+    order_id, item_id, item_name, base_price, size, size_delta,
+    modifiers, mods_text, qty, line_total, item_notes
+) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+"""
+# Items come back pre-grouped as one JSON array per order ('[]' if none)
+SQL_ACTIVE_ORDERS = """
+SELECT o.id, o.created_at, o.service_type, o.table_number, o.status,
+       (SELECT json_group_array(json_object(
+                   'name', oi.item_name, 'qty', oi.qty, 'size', oi.size,
+                   'mods', oi.mods_text, 'notes', oi.item_notes))
+        FROM (SELECT item_name, qty, size, mods_text, item_notes FROM order_items
+              WHERE order_id = o.id AND voided = 0 ORDER BY id) AS oi) AS items
+FROM orders o
+WHERE o.archived = 0 AND o.status IN ('new','in_progress','ready')
+ORDER BY o.id DESC
+"""
+SQL_TODAY_STATS = """
+SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(AVG(total), 0)
+FROM orders
+WHERE created_at >= ? AND created_at < ? AND archived = 0
+"""
+# One fixed text for every filter combination: statuses bind as a JSON array
+# ('[]' = any), paid as 0/1 or NULL (= any).
+SQL_MANAGER_ORDERS = """
+SELECT id AS OrderID, created_at AS Created, customer_name AS Customer, service_type AS Service,
+       status AS Status, paid AS Paid, total AS Total
+FROM orders
+WHERE created_at >= ? AND created_at < ?
+  AND (? = '[]' OR status IN (SELECT value FROM json_each(?)))
+  AND (? IS NULL OR paid = ?)
+ORDER BY id DESC
+"""
+SQL_UPSERT_CUSTOMER = """
+INSERT INTO customers (name, phone, orders_count, total_spent) VALUES (?,?,1,?)
+ON CONFLICT(phone) DO UPDATE SET
+    orders_count = orders_count + 1,
+    total_spent = total_spent + excluded.total_spent
+"""
+SQL_SET_STATUS = "UPDATE orders SET status=? WHERE id=?"
+SQL_SET_PAID = "UPDATE orders SET paid=1 WHERE id=?"
+# Every finished attempt (success or error) bumps stripe_checkout_attempt, so the
+# next attempt uses a new idempotency key instead of replaying this one.
+SQL_SET_SESSION = """
+UPDATE orders SET stripe_session_url=?, stripe_session_expires_at=?,
+                  stripe_checkout_attempt = stripe_checkout_attempt + 1
+WHERE id=?
+"""
+SQL_BUMP_CHECKOUT_ATTEMPT = "UPDATE orders SET stripe_checkout_attempt = stripe_checkout_attempt + 1 WHERE id=?"
+
+
+@st.cache_resource(show_spinner=False)
+def _db() -> Database:
+    # WAL pool from db.py (shared with webhook.py); built once per process, not per rerun
+    return Database(DB_FILE, readers=DB_READERS)
+
+
+def get_reader() -> ContextManager[sqlite3.Connection]:
+    return _db().reader()
+
+
+def get_writer() -> ContextManager[sqlite3.Connection]:
+    """Serialized write transaction (BEGIN IMMEDIATE ... COMMIT / ROLLBACK)."""
+    return _db().writer()
+
+
+# Columns that databases created by older versions may lack, per table
+COLUMN_MIGRATIONS: Dict[str, List[Tuple[str, str]]] = {
+    "orders": [
+        ("source", "TEXT DEFAULT 'POS'"),
+        ("archived", "INTEGER DEFAULT 0"),
+        ("stripe_session_url", "TEXT"),
+        ("stripe_session_expires_at", "INTEGER"),
+        ("stripe_checkout_attempt", "INTEGER DEFAULT 0"),
+    ],
+    "order_items": [
+        ("mods_text", "TEXT"),
+    ],
+}
+
+
+def _migrate_columns(cur: sqlite3.Cursor) -> None:
+    # One table_info per table; ALTER only what is actually missing
+    for table, columns in COLUMN_MIGRATIONS.items():
+        existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+        for column, decl in columns:
+            if column not in existing:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+@st.cache_resource(show_spinner=False)
+def init_db() -> bool:
+    # Schema checks/migrations run once per server process, not on every rerun
+    with get_writer() as con:
+        _create_schema(con.cursor())
+    return True
+
+
+def _create_schema(cur: sqlite3.Cursor) -> None:
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS customers (
@@ -188,7 +385,7 @@ def init_db():
         """
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            created_at TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             customer_name TEXT,
             customer_phone TEXT,
             service_type TEXT,
@@ -204,7 +401,10 @@ def init_db():
             delivery_fee REAL DEFAULT 0,
             tip REAL DEFAULT 0,
             total REAL DEFAULT 0,
-            archived INTEGER DEFAULT 0
+            archived INTEGER DEFAULT 0,
+            stripe_session_url TEXT,
+            stripe_session_expires_at INTEGER,
+            stripe_checkout_attempt INTEGER DEFAULT 0
         )
         """
     )
@@ -223,35 +423,49 @@ def init_db():
             line_total REAL,
             item_notes TEXT,
             voided INTEGER DEFAULT 0,
+            mods_text TEXT,
             FOREIGN KEY(order_id) REFERENCES orders(id)
         )
         """
     )
-    con.commit(); con.close()
+    _migrate_columns(cur)
+    # One-time backfill for rows written before mods_text existed
+    cur.execute(
+        """
+        UPDATE order_items
+        SET mods_text = COALESCE(
+            (SELECT group_concat(json_extract(value, '$.name'), ', ') FROM json_each(order_items.modifiers)), ''
+        )
+        WHERE mods_text IS NULL AND json_valid(COALESCE(modifiers, '[]'))
+        """
+    )
+    # Manager date range, KDS active-order scan, and the KDS items join
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_active_status ON orders(archived, status, id DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id, voided)")
+    # Covers Today at a Glance: archived=0 + created_at range, total read from the index
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archived_created ON orders(archived, created_at, total)")
 
 # ---------- Pricing ----------
 
 def find_item(menu: Dict[str, Any], item_id: str) -> Optional[Dict[str, Any]]:
-    for cat in menu.get("categories", []):
-        for it in cat.get("items", []):
-            if it.get("id") == item_id:
-                return it
-    return None
+    if "_index" not in menu:
+        index_menu(menu)
+    return menu["_index"].get(item_id)
 
 
-def calc_line_total(menu: Dict[str, Any], item_id: str, qty: int, size_name: Optional[str], modifiers: List[Dict[str, Any]]) -> float:
+def calc_unit_price(menu: Dict[str, Any], item_id: str, size_name: Optional[str], modifiers: List[Dict[str, Any]]) -> float:
     it = find_item(menu, item_id)
     if not it:
         return 0.0
     base = float(it.get("base_price", 0))
-    size_delta = 0.0
-    if size_name and it.get("sizes"):
-        for s in it["sizes"]:
-            if s["name"] == size_name:
-                size_delta = float(s.get("price_delta", 0))
-                break
+    size_delta = it["_size_delta"].get(size_name, 0.0) if size_name else 0.0
     mods_total = sum(float(m.get("price_delta", 0)) for m in modifiers)
-    return (base + size_delta + mods_total) * max(1, int(qty))
+    return base + size_delta + mods_total
+
+
+def calc_line_total(menu: Dict[str, Any], item_id: str, qty: int, size_name: Optional[str], modifiers: List[Dict[str, Any]]) -> float:
+    return calc_unit_price(menu, item_id, size_name, modifiers) * max(1, int(qty))
 
 
 def calc_order_totals(subtotal: float, tax_rate: float, discount: float, delivery_fee: float, tip: float) -> Dict[str, float]:
@@ -275,13 +489,28 @@ def init_state():
     st.session_state.setdefault("tax_rate", DEFAULT_TAX_RATE)
     st.session_state.setdefault("delivery_fee", DEFAULT_DELIVERY_FEE)
     st.session_state.setdefault("pin", DEFAULT_PIN)
+    # Coerced once here; number_input with float bounds keeps them floats after that
+    st.session_state.tax_rate = float(st.session_state.tax_rate)
+    st.session_state.delivery_fee = float(st.session_state.delivery_fee)
 
 # ---------- UI helpers ----------
 
+def _qp1(qp: Mapping[str, str], name: str) -> Optional[str]:
+    """A query param from st.query_params (or a dict of it), None if missing/empty.
+
+    st.query_params always maps a key to its last value as a str. Only the
+    old experimental_get_query_params API returned lists, so there is no list
+    case to handle."""
+    return qp.get(name) or None
+
+
 def open_in_new_tab(url: str):
     st_html(f"<script>window.open('{url}', '_blank');</script>", height=0)
 
 
+# A fragment: picking category/item/size/toppings reruns only this picker, not the
+# whole page. Adding to the cart changes the subtotal, so that one does a full rerun.
+@st.fragment
 def add_item_ui(menu: Dict[str, Any]):
     st.subheader("Add Item")
     cat_names = [c["name"] for c in menu.get("categories", [])]
@@ -297,22 +526,20 @@ def add_item_ui(menu: Dict[str, Any]):
     qty = st.number_input("Qty", 1, 99, 1)
 
     size = None
-    size_delta_map = {}
-    if item.get("sizes"):
-        size = st.selectbox("Size", [s["name"] for s in item["sizes"]])
-        size_delta_map = {s["name"]: float(s.get("price_delta", 0)) for s in item["sizes"]}
+    size_delta_map = item.get("_size_delta", {})
+    if size_delta_map:
+        size = st.selectbox("Size", list(size_delta_map))
 
     chosen_mods = []
-    if item.get("available_toppings"):
-        mods = [m["name"] for m in item["available_toppings"]]
-        selected = st.multiselect("Toppings", mods)
-        price_lookup = {m["name"]: float(m["price_delta"]) for m in item["available_toppings"]}
+    price_lookup = item.get("_topping_delta", {})
+    if price_lookup:
+        selected = st.multiselect("Toppings", list(price_lookup))
         chosen_mods = [{"name": m, "price_delta": price_lookup[m]} for m in selected]
 
     item_notes = st.text_input("Item notes (optional)")
 
     if st.button("Add to Cart", use_container_width=True):
-        line_total = calc_line_total(menu, item["id"], qty, size, chosen_mods)
+        unit_price = calc_unit_price(menu, item["id"], size, chosen_mods)
         st.session_state.cart.append({
             "item_id": item["id"],
             "item_name": item["name"],
@@ -322,9 +549,21 @@ def add_item_ui(menu: Dict[str, Any]):
             "modifiers": chosen_mods,
             "item_notes": item_notes.strip() if item_notes else None,
             "base_price": float(item.get("base_price", 0)),
-            "line_total": float(line_total),
+            "unit_price": float(unit_price),
+            "line_total": float(unit_price) * int(qty),
         })
-        st.success(f"Added {qty} × {item['name']} to cart")
+        st.toast(f"Added {qty} × {item['name']} to cart")
+        st.rerun()
+
+
+def _bump_qty(i: int, delta: int):
+    line = st.session_state.cart[i]
+    line["qty"] = max(1, int(line["qty"]) + delta)
+    line["line_total"] = line["unit_price"] * line["qty"]
+
+
+def _remove_line(i: int):
+    st.session_state.cart.pop(i)
 
 
 def cart_summary_ui(menu: Dict[str, Any]) -> float:
@@ -332,8 +571,11 @@ def cart_summary_ui(menu: Dict[str, Any]) -> float:
     if not st.session_state.cart:
         st.info("Cart is empty.")
         return 0.0
-    subtotal = 0.0
     for i, line in enumerate(st.session_state.cart):
+        # Priced once when added; qty changes are just a multiply.
+        unit_price = line.get("unit_price")
+        if unit_price is None:
+            unit_price = line["unit_price"] = calc_unit_price(menu, line["item_id"], line.get("size"), line.get("modifiers", []))
         with st.container(border=True):
             st.markdown(f"**{line['item_name']}** × {line['qty']}")
             if line.get("size"):
@@ -342,91 +584,144 @@ def cart_summary_ui(menu: Dict[str, Any]) -> float:
                 mods = ", ".join([f"{m['name']} ({CURRENCY}{m['price_delta']})" for m in line["modifiers"]])
                 st.caption(f"Toppings: {mods}")
             st.write(money(line["line_total"]))
+            # Callbacks run before the rerun, so this line already shows the new qty
             cols = st.columns(3)
-            if cols[0].button("−1", key=f"dec_{i}"):
-                line["qty"] = max(1, int(line["qty"]) - 1)
-                line["line_total"] = calc_line_total(menu, line["item_id"], line["qty"], line.get("size"), line.get("modifiers", []))
-            if cols[1].button("+1", key=f"inc_{i}"):
-                line["qty"] = int(line["qty"]) + 1
-                line["line_total"] = calc_line_total(menu, line["item_id"], line["qty"], line.get("size"), line.get("modifiers", []))
-            if cols[2].button("Remove", key=f"rm_{i}"):
-                st.session_state.cart.pop(i)
-                st.rerun()
-        subtotal += float(line["line_total"])
+            cols[0].button("−1", key=f"dec_{i}", on_click=_bump_qty, args=(i, -1))
+            cols[1].button("+1", key=f"inc_{i}", on_click=_bump_qty, args=(i, 1))
+            cols[2].button("Remove", key=f"rm_{i}", on_click=_remove_line, args=(i,))
+    subtotal = math.fsum(float(line["line_total"]) for line in st.session_state.cart)
     st.markdown(f"**Subtotal:** {money(subtotal)}")
     return subtotal
 
 # ---------- Stripe helpers ----------
 
-def create_or_get_customer(con, name: str, phone: str):
-    cur = con.cursor()
+def upsert_customer(cur: sqlite3.Cursor, name: str, phone: str, total: float) -> None:
+    """Create the customer or bump their order stats, in one statement (runs inside the order transaction)."""
     if not phone:
-        return None
-    cur.execute("SELECT id FROM customers WHERE phone=?", (phone,))
-    row = cur.fetchone()
-    if row:
-        return row[0]
-    cur.execute("INSERT INTO customers (name, phone) VALUES (?,?)", (name, phone))
-    con.commit()
-    return cur.lastrowid
+        return
+    cur.execute(SQL_UPSERT_CUSTOMER, (name, phone, total))
+
+
+@st.cache_resource(show_spinner=False)
+def _stripe_executor() -> ThreadPoolExecutor:
+    # The Stripe SDK is thread-safe; lets independent calls (Admin "Ping + test") run side by side.
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="stripe")
+
+
+def _create_checkout_session(
+    order_ref: Any, product_name: str, amount_cents: int,
+    metadata: Optional[Dict[str, str]] = None, idempotency_key: Optional[str] = None,
+) -> Any:
+    # No st.* calls in here: it may run on a worker thread.
+    extra: Dict[str, Any] = {"metadata": metadata} if metadata else {}
+    if idempotency_key:
+        extra["idempotency_key"] = idempotency_key
+    session = _stripe().checkout.Session.create(
+        mode="payment",
+        line_items=[{
+            "price_data": {
+                "currency": "usd",
+                "product_data": {"name": product_name},
+                "unit_amount": amount_cents,
+            },
+            "quantity": 1,
+        }],
+        success_url=SUCCESS_TEMPLATE.format(oid=order_ref),
+        cancel_url=CANCEL_TEMPLATE.format(oid=order_ref),
+        **extra,
+    )
+    return session
+
+
+def _create_order_session(order_id: int, customer_name: Optional[str], amount_cents: int, attempt: int) -> str:
+    """New Checkout Session for an order, stored on the order row.
+
+    Concurrent calls for the same attempt share one idempotency key, so Stripe
+    hands both the same session. A finished attempt (stored or failed) moves
+    the counter on, so a retry after an error or an expiry is never replayed."""
+    try:
+        session = _create_checkout_session(
+            order_id, f"Order #{order_id} - {customer_name or 'Guest'}", amount_cents, {"order_id": str(order_id)},
+            idempotency_key=f"order-{order_id}-v{attempt + 1}",
+        )
+    except Exception:
+        with get_writer() as con:
+            con.execute(SQL_BUMP_CHECKOUT_ATTEMPT, (order_id,))
+        raise
+    with get_writer() as con:
+        con.execute(SQL_SET_SESSION, (session.url, session.expires_at, order_id))
+    return session.url
+
+
+def _create_test_session() -> str:
+    # order_id=TEST is recognised on return; no metadata so the webhook ignores it
+    return _create_checkout_session("TEST", "Test $1 charge", 100).url
 
 
 def create_checkout_for_order(order_id: int) -> Optional[str]:
-    if not (STRIPE_ENABLED and stripe.api_key):
+    if not stripe_ready():
         st.error("Stripe not configured.")
         return None
     try:
-        con = get_conn(); cur = con.cursor()
-        cur.execute("SELECT customer_name, total FROM orders WHERE id=?", (order_id,))
-        row = cur.fetchone(); con.close()
+        with get_reader() as con:
+            row = con.execute(
+                "SELECT customer_name, total, stripe_session_url, stripe_session_expires_at, stripe_checkout_attempt"
+                " FROM orders WHERE id=?", (order_id,)
+            ).fetchone()
         if not row:
             st.error("Order not found.")
             return None
-        customer_name, total = row
+        customer_name, total, session_url, expires_at, attempt = row
+        # Reuse only a session the customer still has time to finish
+        if session_url and (expires_at or 0) > datetime.now(timezone.utc).timestamp() + CHECKOUT_REUSE_MARGIN:
+            return session_url
         amount_cents = int(round(float(total) * 100))
         if amount_cents <= 0:
             st.error("Total must be > 0 to create checkout.")
             return None
-
-        success_url = f"{PUBLIC_BASE_URL}?checkout=success&order_id={order_id}&session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url  = f"{PUBLIC_BASE_URL}?checkout=canceled&order_id={order_id}"
-
-        session = stripe.checkout.Session.create(
-            mode="payment",
-            line_items=[{
-                "price_data": {
-                    "currency": "usd",
-                    "product_data": {"name": f"Order #{order_id} - {customer_name or 'Guest'}"},
-                    "unit_amount": amount_cents,
-                },
-                "quantity": 1,
-            }],
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={"order_id": str(order_id)},
-        )
-        return session.url
+        return _create_order_session(order_id, customer_name, amount_cents, attempt or 0)
     except Exception as e:
         st.error(f"Stripe error: {e}")
         return None
 
 
-def trigger_checkout(url: str, key_suffix: Optional[str] = None):
+def show_checkout(url: str, key_suffix: Optional[str] = None):
+    """Checkout link + retry; the popup script is injected once per URL, not every rerun."""
     ks = key_suffix or hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
-    st.session_state["last_checkout_url"] = url
-    open_in_new_tab(url)
-    try:
-        st.link_button("Open secure checkout", url, use_container_width=True, key=f"open_{ks}")
-    except Exception:
-        st.markdown(f"[Open secure checkout]({url})")
-    if st.button("Try popup again", key=f"retry_{ks}"):
+    cols = st.columns([3, 2])
+    with cols[0]:
+        try:
+            st.link_button("Open secure checkout", url, use_container_width=True, key=f"open_{ks}")
+        except Exception:
+            st.markdown(f"[Open secure checkout]({url})")
+    retry = cols[1].button("Try popup again", key=f"retry_{ks}", use_container_width=True)
+    if retry or st.session_state.get("checkout_popup_attempted") != url:
+        st.session_state["checkout_popup_attempted"] = url
         open_in_new_tab(url)
-    st.info("If nothing opened, check your popup blocker.")
+    st.caption("If nothing opened, check your popup blocker.")
+
+
+def render_checkout_banner():
+    """Pay link for the last order placed here; stays up across reruns until dismissed."""
+    oid = st.session_state.get("last_order_id")
+    url = st.session_state.get("last_checkout_url")
+    if not (oid and url):
+        return
+    with st.container(border=True):
+        head = st.columns([5, 1])
+        head[0].markdown(f"**Order #{oid}** · waiting for payment")
+        if head[1].button("Dismiss", key=f"dismiss_last_{oid}", use_container_width=True):
+            st.session_state.pop("last_order_id", None)
+            st.session_state.pop("last_checkout_url", None)
+            st.rerun()
+        show_checkout(url, key_suffix=f"last_{oid}")
 
 # ---------- Order flow ----------
 
 def place_order_ui(menu: Dict[str, Any]):
     st.header("Front Desk · Take Orders")
+    # Filled in last, so it already reflects an order placed on this run
+    banner = st.container()
 
     with st.container(border=True):
         st.subheader("Build Cart")
@@ -442,13 +737,13 @@ def place_order_ui(menu: Dict[str, Any]):
 
         service_type = st.radio("Service type", SERVICE_TYPES, horizontal=True)
         table_number = st.text_input("Table number (optional)") if service_type == "Dine-In" else None
-        delivery_fee = st.number_input("Delivery fee", 0.0, 99.0, float(st.session_state.delivery_fee)) if service_type == "Delivery" else 0.0
+        delivery_fee = st.number_input("Delivery fee", 0.0, 99.0, st.session_state.delivery_fee) if service_type == "Delivery" else 0.0
 
         st.divider()
         cols2 = st.columns(3)
         discount = cols2[0].number_input("Discount (amount)", 0.0, 999.0, 0.0)
         tip = cols2[1].number_input("Tip", 0.0, 999.0, 0.0)
-        tax_rate = cols2[2].number_input("Tax Rate", 0.0, 0.5, float(st.session_state.tax_rate))
+        tax_rate = cols2[2].number_input("Tax Rate", 0.0, 0.5, st.session_state.tax_rate)
 
         notes = st.text_area("Order notes (optional)")
 
@@ -457,124 +752,143 @@ def place_order_ui(menu: Dict[str, Any]):
 
         pay_and_submit = st.form_submit_button("Pay with Stripe", type="primary", use_container_width=True)
 
-    if pay_and_submit:
-        if not st.session_state.cart:
-            st.error("Cart is empty.")
-            return
-        con = get_conn(); cur = con.cursor()
-        created_at = datetime.now().isoformat(timespec="seconds")
-        # Optional: create or update customer
-        if customer_phone:
-            _ = create_or_get_customer(con, (customer_name or "").strip(), (customer_phone or "").strip())
-
-        cur.execute(
-            """
-            INSERT INTO orders (
-                created_at, customer_name, customer_phone, service_type, table_number,
-                status, paid, payment_method, notes, source,
-                subtotal, tax, discount, delivery_fee, tip, total
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                created_at, customer_name.strip() if customer_name else None,
-                customer_phone.strip() if customer_phone else None,
-                service_type, table_number,
-                "new", 0, "Card (Stripe)", notes, "POS",
-                totals["subtotal"], totals["tax"], totals["discount"], totals["delivery_fee"], totals["tip"], totals["total"],
-            ),
-        )
-        order_id = cur.lastrowid
+    if pay_and_submit and not st.session_state.cart:
+        st.error("Cart is empty.")
+    elif pay_and_submit:
+        customer_name = customer_name.strip() if customer_name else None
+        with get_writer() as con:
+            cur = con.cursor()
+            # Optional: create or update customer
+            upsert_customer(cur, customer_name or "", (customer_phone or "").strip(), totals["total"])
 
-        for line in st.session_state.cart:
             cur.execute(
-                """
-                INSERT INTO order_items (
-                    order_id, item_id, item_name, base_price, size, size_delta,
-                    modifiers, qty, line_total, item_notes
-                ) VALUES (?,?,?,?,?,?,?,?,?,?)
-                """,
+                SQL_INSERT_ORDER,
                 (
-                    order_id,
-                    line["item_id"], line["item_name"], line["base_price"],
-                    line.get("size"), line.get("size_delta", 0.0),
-                    json.dumps(line.get("modifiers", []), ensure_ascii=False),
-                    int(line["qty"]), float(line["line_total"]),
-                    line.get("item_notes"),
+                    customer_name,
+                    customer_phone.strip() if customer_phone else None,
+                    service_type, table_number,
+                    "new", 0, "Card (Stripe)", notes, "POS",
+                    totals["subtotal"], totals["tax"], totals["discount"], totals["delivery_fee"], totals["tip"], totals["total"],
                 ),
             )
-        con.commit(); con.close()
+            order_id = cur.lastrowid
+
+            cur.executemany(
+                SQL_INSERT_ITEM,
+                [
+                    (
+                        order_id,
+                        line["item_id"], line["item_name"], line["base_price"],
+                        line.get("size"), line.get("size_delta", 0.0),
+                        _json_dumps(line.get("modifiers", [])),
+                        ", ".join(m["name"] for m in line.get("modifiers", [])),
+                        int(line["qty"]), float(line["line_total"]),
+                        line.get("item_notes"),
+                    )
+                    for line in st.session_state.cart
+                ],
+            )
 
         st.session_state.cart = []
         st.session_state["last_order_id"] = int(order_id)
+        st.session_state["last_checkout_url"] = None
         st.success(f"Order #{order_id} placed!")
 
-        if STRIPE_ENABLED and stripe.api_key:
-            url = create_checkout_for_order(order_id)
-            if url:
-                trigger_checkout(url)
-            else:
+        # The session needs the committed order_id, so there is nothing to overlap it with
+        amount_cents = int(round(totals["total"] * 100))
+        if stripe_ready() and amount_cents > 0:
+            try:
+                url = _create_order_session(order_id, customer_name, amount_cents, 0)
+                st.session_state["last_checkout_url"] = url
+            except Exception as e:
+                st.error(f"Stripe error: {e}")
                 st.error("Could not start checkout. See Admin → Stripe diagnostics.")
+        elif amount_cents <= 0:
+            st.error("Total must be > 0 to create checkout.")
         else:
             st.error("Stripe disabled or API key missing.")
 
+    with banner:
+        render_checkout_banner()
+
 # ---------- Kitchen (KDS) ----------
 
 def kitchen_ui():
     st.header("Kitchen Display (KDS)")
-    con = get_conn(); cur = con.cursor()
-    cur.execute("SELECT id, created_at, service_type, table_number, status FROM orders WHERE archived=0 AND status IN ('new','in_progress','ready') ORDER BY id DESC")
-    orders = cur.fetchall()
-    if not orders:
+    with get_reader() as con:
+        rows = con.execute(SQL_ACTIVE_ORDERS).fetchall()
+    if not rows:
         st.info("No active orders.")
-        con.close(); return
+        return
 
-    for oid, created_at, service_type, table_number, status in orders:
+    # One vectorized parse for the whole board; created_at is UTC, the kitchen reads local time
+    placed = pd.to_datetime([r[1] for r in rows], utc=True, errors="coerce").tz_convert(datetime.now().astimezone().tzinfo)
+
+    for (oid, created_at, service_type, table_number, status, items_json), when in zip(rows, placed):
         with st.container(border=True):
             cols = st.columns([2,2,2,2,3])
             cols[0].markdown(f"**Order #{oid}**")
-            cols[1].write(str(created_at))
+            cols[1].write(str(created_at) if pd.isna(when) else when.strftime("%Y-%m-%d %H:%M:%S"))
             cols[2].write(service_type)
             cols[3].write(table_number or "-")
             cols[4].write(f"Status: **{status}**")
 
-            icur = con.cursor()
-            icur.execute("SELECT item_name, qty, size, modifiers, item_notes FROM order_items WHERE order_id=? AND voided=0", (oid,))
-            for iname, qty, size, mods, notes in icur.fetchall():
-                line = f"{iname} × {qty}"
-                if size:
-                    line += f" · {size}"
-                if mods:
-                    try:
-                        mods_list = [m.get("name") for m in json.loads(mods or "[]")] or []
-                        if mods_list:
-                            line += f" · +{', '.join(mods_list)}"
-                    except Exception:
-                        pass
+            for it in _json_loads(items_json):
+                line = f"{it['name']} × {it['qty']}"
+                if it["size"]:
+                    line += f" · {it['size']}"
+                if it["mods"]:
+                    line += f" · +{it['mods']}"
                 st.write(line)
-                if notes:
-                    st.caption(f"Notes: {notes}")
+                if it["notes"]:
+                    st.caption(f"Notes: {it['notes']}")
 
             c2 = st.columns(3)
             if c2[0].button("Start", key=f"start_{oid}"):
-                cur.execute("UPDATE orders SET status='in_progress' WHERE id=?", (oid,)); con.commit(); st.rerun()
+                with get_writer() as con:
+                    con.execute(SQL_SET_STATUS, ("in_progress", oid))
+                st.rerun()
             if c2[1].button("Ready", key=f"ready_{oid}"):
-                cur.execute("UPDATE orders SET status='ready' WHERE id=?", (oid,)); con.commit(); st.rerun()
+                with get_writer() as con:
+                    con.execute(SQL_SET_STATUS, ("ready", oid))
+                st.rerun()
             if c2[2].button("Complete", key=f"done_{oid}"):
-                cur.execute("UPDATE orders SET status='completed' WHERE id=?", (oid,)); con.commit(); st.rerun()
-    con.close()
+                with get_writer() as con:
+                    con.execute(SQL_SET_STATUS, ("completed", oid))
+                st.rerun()
 
 # ---------- Manager ----------
 
+@st.cache_data(ttl=5, show_spinner=False)
+def _manager_query(
+    date_from_iso: str, date_to_iso: str, statuses: Tuple[str, ...], paid_filter: str
+) -> Tuple[pd.DataFrame, bytes]:
+    """Orders in [date_from_iso, date_to_iso) matching the manager filters, plus
+    their CSV export. One query and one cache entry, so the download always
+    holds exactly the rows in the grid."""
+    # Half-open range instead of DATE(created_at) so idx_orders_created is usable
+    status_json = _json_dumps(list(statuses))
+    paid = {"Paid only": 1, "Unpaid only": 0}.get(paid_filter)
+    params = (date_from_iso, date_to_iso, status_json, status_json, paid, paid)
+    with get_reader() as con:
+        df = pd.read_sql_query(SQL_MANAGER_ORDERS, con, params=params)
+    # Encode straight into one bytes buffer, in chunks, instead of str -> bytes copies
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8", chunksize=5000)
+    return df, buf.getvalue()
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _today_stats(day_start_iso: str, day_end_iso: str) -> Tuple[int, float, float]:
+    """(count, gross, average) of non-archived orders in [day_start_iso, day_end_iso)."""
+    with get_reader() as con:
+        return tuple(con.execute(SQL_TODAY_STATS, (day_start_iso, day_end_iso)).fetchone())
+
+
 def manager_ui():
-    def _qp1(name):
-        v = st.query_params.get(name)
-        if isinstance(v, list):
-            return (v[0] if v else None)
-        return v
-    readonly = (_qp1("readonly") or "").lower() in {"1","true","yes"}
+    readonly = (_qp1(st.query_params, "readonly") or "").lower() in {"1","true","yes"}
 
     st.header("Manager · Orders & Reports")
-    con = get_conn(); cur = con.cursor()
 
     cols = st.columns(4)
     date_from = cols[0].date_input("From", date.today())
@@ -582,62 +896,130 @@ def manager_ui():
     status_f = cols[2].multiselect("Status", STATUS_CHOICES, default=[])
     paid_filter = cols[3].selectbox("Paid?", ["All","Paid only","Unpaid only"])
 
-    q = "SELECT id, created_at, customer_name, service_type, status, paid, total FROM orders WHERE DATE(created_at) BETWEEN ? AND ?"
-    params = [date_from.isoformat(), date_to.isoformat()]
-    if status_f:
-        q += " AND status IN (%s)" % ",".join(["?"]*len(status_f)); params += status_f
-    if paid_filter == "Paid only":
-        q += " AND paid=1"
-    elif paid_filter == "Unpaid only":
-        q += " AND paid=0"
-    q += " ORDER BY id DESC"
-
-    cur.execute(q, params)
-    rows = cur.fetchall()
-
-    df = pd.DataFrame(rows, columns=["OrderID","Created","Customer","Service","Status","Paid","Total"])
+    filters = (*utc_day_range(date_from, date_to), tuple(status_f), paid_filter)
+    df, csv_bytes = _manager_query(*filters)
     st.dataframe(df, hide_index=True, use_container_width=True)
 
     if not df.empty:
         today_str = date.today().isoformat()
-        st.download_button("Export CSV", df.to_csv(index=False).encode("utf-8"), file_name=f"orders_{today_str}.csv")
+        st.download_button("Export CSV", csv_bytes, file_name=f"orders_{today_str}.csv")
 
     if not readonly:
-        st.subheader("Quick Actions")
-        oid = st.number_input("Order ID", min_value=1, step=1)
-        cols2 = st.columns(4)
-        if cols2[0].button("Toggle Paid"):
-            cur.execute("UPDATE orders SET paid = CASE paid WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (int(oid),)); con.commit(); st.success("Paid toggled.")
-        if cols2[1].button("Archive"):
-            cur.execute("UPDATE orders SET archived=1 WHERE id=?", (int(oid),)); con.commit(); st.success("Archived.")
-        if cols2[2].button("Unarchive"):
-            cur.execute("UPDATE orders SET archived=0 WHERE id=?", (int(oid),)); con.commit(); st.success("Unarchived.")
-        if cols2[3].button("Mark Completed"):
-            cur.execute("UPDATE orders SET status='completed' WHERE id=?", (int(oid),)); con.commit(); st.success("Status updated.")
-
-        if STRIPE_ENABLED and stripe.api_key:
-            if st.button("Create Stripe Checkout for Order ID above"):
-                url = create_checkout_for_order(int(oid))
-                if url:
-                    trigger_checkout(url)
-                else:
-                    st.error("Could not create checkout (order not found or Stripe not configured).")
-
-    # Metrics
+        _quick_actions_ui([int(i) for i in df["OrderID"]])
+
+    _today_glance_ui()
+
+
+# A fragment: an action click reruns only this block (one UPDATE), not the order
+# list and aggregates above. Their caches are cleared, so "Refresh list" or the
+# next filter change shows the result.
+@st.fragment
+def _quick_actions_ui(listed_ids: List[int]):
+    st.subheader("Quick Actions")
+    oid = st.number_input("Order ID", min_value=1, step=1)
+    cols2 = st.columns(4)
+    if cols2[0].button("Toggle Paid"):
+        with get_writer() as con:
+            con.execute("UPDATE orders SET paid = CASE paid WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (int(oid),))
+        _manager_query.clear()
+        st.success("Paid toggled.")
+    if cols2[1].button("Archive"):
+        with get_writer() as con:
+            con.execute("UPDATE orders SET archived=1 WHERE id=?", (int(oid),))
+        _manager_query.clear(); _today_stats.clear()
+        st.success("Archived.")
+    if cols2[2].button("Unarchive"):
+        with get_writer() as con:
+            con.execute("UPDATE orders SET archived=0 WHERE id=?", (int(oid),))
+        _manager_query.clear(); _today_stats.clear()
+        st.success("Unarchived.")
+    if cols2[3].button("Mark Completed"):
+        with get_writer() as con:
+            con.execute(SQL_SET_STATUS, ("completed", int(oid)))
+        _manager_query.clear()
+        st.success("Status updated.")
+
+    if stripe_ready():
+        if st.button("Create Stripe Checkout for Order ID above"):
+            url = create_checkout_for_order(int(oid))
+            if url:
+                # The stored URL is reused per order, so re-arm the popup for this click
+                st.session_state.pop("checkout_popup_attempted", None)
+                show_checkout(url)
+            else:
+                st.error("Could not create checkout (order not found or Stripe not configured).")
+
+    # Bulk: one transaction (one commit) for the whole selection
+    picked = st.multiselect("Bulk: orders from the list above", listed_ids)
+    cols3 = st.columns(2)
+    if cols3[0].button("Mark selected completed", disabled=not picked):
+        with get_writer() as con:
+            con.executemany(SQL_SET_STATUS, [("completed", i) for i in picked])
+        _manager_query.clear()
+        st.success(f"{len(picked)} order(s) marked completed.")
+    if cols3[1].button("Unarchive selected", disabled=not picked):
+        with get_writer() as con:
+            con.executemany("UPDATE orders SET archived=0 WHERE id=?", [(i,) for i in picked])
+        _manager_query.clear(); _today_stats.clear()
+        st.success(f"{len(picked)} order(s) unarchived.")
+
+    if st.button("Refresh list"):
+        st.rerun()
+
+
+def _today_glance_ui():
     st.subheader("Today at a Glance")
-    cur.execute("SELECT COUNT(*), SUM(total) FROM orders WHERE DATE(created_at)=DATE('now') AND archived=0")
-    cnt, gross = cur.fetchone()
+    cnt, gross, avg_t = _today_stats(*utc_day_range(date.today(), date.today()))
     colA, colB, colC = st.columns(3)
-    colA.metric("Orders Today", cnt or 0)
-    colB.metric("Gross Sales", money(gross or 0))
-    cur.execute("SELECT AVG(total) FROM orders WHERE DATE(created_at)=DATE('now') AND archived=0")
-    avg_t = cur.fetchone()[0] or 0
+    colA.metric("Orders Today", cnt)
+    colB.metric("Gross Sales", money(gross))
     colC.metric("Avg Ticket", money(avg_t))
 
-    con.close()
-
 # ---------- Admin ----------
 
+@st.cache_data(ttl=60, show_spinner=False)
+def _ping_stripe(key_suffix: str) -> Optional[str]:
+    # key_suffix keys the cache so a rotated key is pinged again right away
+    return _stripe().Account.retrieve().get("id")
+
+
+def _stripe_diagnostics_ui():
+    # Captions come from the key string; the SDK is only imported when a button is clicked
+    env_key = (os.getenv("STRIPE_SECRET_KEY") or "").strip()
+    st.caption(f"Loaded key: {'(none)' if not env_key else env_key[:10] + '…' + env_key[-6:]} | Ready: {stripe_ready()}")
+    st.caption(f"PUBLIC_BASE_URL: {PUBLIC_BASE_URL}")
+    c0, c1, c2, c3, c4 = st.columns(5)
+    if c0.button("Reload key from env/secrets"):
+        _stripe().api_key = _get_secret_env("STRIPE_SECRET_KEY", "")
+        st.success("Reloaded into SDK.")
+    if c1.button("Ping Stripe (Account.retrieve)"):
+        try:
+            st.success(f"✅ Key valid. Account: {_ping_stripe(STRIPE_SECRET_KEY[-6:])}")
+        except Exception as e:
+            st.error(f"❌ {e}")
+    if c4.button("Force refresh ping"):
+        _ping_stripe.clear()
+        st.success("Ping cache cleared.")
+    if c2.button("Create $1 test Checkout"):
+        try:
+            show_checkout(_create_test_session())
+        except Exception as e:
+            st.error(f"Failed to create test session: {e}")
+    if c3.button("Ping + test Checkout"):
+        # Independent round-trips: run them side by side instead of back to back.
+        pool = _stripe_executor()
+        ping = pool.submit(_stripe().Account.retrieve)
+        test = pool.submit(_create_test_session)
+        try:
+            st.success(f"✅ Key valid. Account: {ping.result().get('id')}")
+        except Exception as e:
+            st.error(f"❌ {e}")
+        try:
+            show_checkout(test.result())
+        except Exception as e:
+            st.error(f"Failed to create test session: {e}")
+
+
 def admin_ui():
     st.header("Admin")
     if not st.session_state.admin_unlocked:
@@ -654,76 +1036,54 @@ def admin_ui():
     st.success("Admin mode active")
 
     with st.expander("Settings", expanded=True):
-        st.session_state.tax_rate = st.number_input("Tax rate", 0.0, 0.5, float(st.session_state.tax_rate))
-        st.session_state.delivery_fee = st.number_input("Default delivery fee", 0.0, 50.0, float(st.session_state.delivery_fee))
+        st.session_state.tax_rate = st.number_input("Tax rate", 0.0, 0.5, st.session_state.tax_rate)
+        st.session_state.delivery_fee = st.number_input("Default delivery fee", 0.0, 50.0, st.session_state.delivery_fee)
         new_pin = st.text_input("Set new PIN", value=st.session_state.pin)
         if st.button("Save Settings"):
             st.session_state.pin = new_pin
             st.success("Settings saved.")
 
     with st.expander("Stripe diagnostics", expanded=False):
-        env_key = (os.getenv("STRIPE_SECRET_KEY") or "").strip()
-        active_key = (getattr(stripe, "api_key", "") or "").strip()
-        st.caption(f"Loaded key: {'(none)' if not env_key else env_key[:10] + '…' + env_key[-6:]} | Ready: {bool(active_key)}")
-        st.caption(f"PUBLIC_BASE_URL: {PUBLIC_BASE_URL}")
-        c0, c1, c2 = st.columns(3)
-        if c0.button("Reload key from env/secrets"):
-            stripe.api_key = _get_secret_env("STRIPE_SECRET_KEY", "")
-            st.success("Reloaded into SDK.")
-        if c1.button("Ping Stripe (Account.retrieve)"):
-            try:
-                acct = stripe.Account.retrieve()
-                st.success(f"✅ Key valid. Account: {acct.get('id')}")
-            except Exception as e:
-                st.error(f"❌ {e}")
-        if c2.button("Create $1 test Checkout"):
-            try:
-                sess = stripe.checkout.Session.create(
-                    mode="payment",
-                    line_items=[{
-                        "price_data": {
-                            "currency": "usd",
-                            "product_data": {"name": "Test $1 charge"},
-                            "unit_amount": 100,
-                        },
-                        "quantity": 1,
-                    }],
-                    success_url=f"{PUBLIC_BASE_URL}?checkout=success&order_id=TEST&session_id={{CHECKOUT_SESSION_ID}}",
-                    cancel_url=f"{PUBLIC_BASE_URL}?checkout=canceled&order_id=TEST",
-                )
-                trigger_checkout(sess.url)
-            except Exception as e:
-                st.error(f"Failed to create test session: {e}")
+        _stripe_diagnostics_ui()
 
     st.subheader("Menu Editor (menu.json)")
-    menu_text = open(MENU_FILE, "r", encoding="utf-8-sig").read()
+    menu_text = _read_menu_text(MENU_FILE, os.path.getmtime(MENU_FILE))
     new_menu_text = st.text_area("menu.json", value=menu_text, height=400)
     if st.button("Save Menu JSON"):
         try:
-            parsed = json.loads(new_menu_text)
-            with open(MENU_FILE, "w", encoding="utf-8") as f:
-                json.dump(parsed, f, indent=2, ensure_ascii=False)
+            save_menu(_json_loads(new_menu_text))
             st.success("Menu saved.")
         except Exception as e:
             st.error(f"Invalid JSON: {e}")
 
 # ---------- Return banner + verification ----------
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _verify_session(session_id: str) -> Optional[str]:
+    # Cached per session_id so reruns / refreshes after return don't re-hit Stripe.
+    return _stripe().checkout.Session.retrieve(session_id).get("payment_status")
+
+
 def init_banner():
-    qp = st.query_params
-    if qp.get("checkout") == ["success"] and qp.get("order_id"):
-        order_id = qp["order_id"][0]
-        session_id = (qp.get("session_id") or [None])[0]
-        if STRIPE_ENABLED and stripe.api_key and session_id and order_id != "TEST":
+    qp = dict(st.query_params)
+    checkout, order_id = _qp1(qp, "checkout"), _qp1(qp, "order_id")
+    if checkout == "success" and order_id:
+        session_id = _qp1(qp, "session_id")
+        if stripe_ready() and session_id and order_id != "TEST":
             try:
-                sess = stripe.checkout.Session.retrieve(session_id)
-                if sess.get("payment_status") == "paid":
-                    con = get_conn(); cur = con.cursor()
-                    cur.execute("UPDATE orders SET paid=1 WHERE id=?", (int(order_id),))
-                    con.commit(); con.close()
-                    st.success(f"Payment confirmed — Order #{order_id} marked paid.")
+                with get_reader() as con:
+                    row = con.execute("SELECT paid FROM orders WHERE id=?", (int(order_id),)).fetchone()
+                if row and row[0]:
+                    # Webhook or an earlier return already recorded it; no Stripe call needed.
+                    st.success(f"Payment confirmed — Order #{order_id} is paid.")
                 else:
-                    st.warning(f"Returned from Stripe — payment status: {sess.get('payment_status')}")
+                    payment_status = _verify_session(session_id)
+                    if payment_status == "paid":
+                        with get_writer() as con:
+                            con.execute(SQL_SET_PAID, (int(order_id),))
+                        st.success(f"Payment confirmed — Order #{order_id} marked paid.")
+                    else:
+                        st.warning(f"Returned from Stripe — payment status: {payment_status}")
             except Exception as e:
                 st.error(f"Payment verification failed: {e}")
         elif order_id == "TEST":
@@ -732,8 +1092,8 @@ def init_banner():
             st.query_params.clear(); st.rerun()
         except Exception:
             pass
-    elif qp.get("checkout") == ["canceled"] and qp.get("order_id"):
-        st.warning(f"Checkout canceled for Order #{qp['order_id'][0]}.")
+    elif checkout == "canceled" and order_id:
+        st.warning(f"Checkout canceled for Order #{order_id}.")
         try:
             st.query_params.clear(); st.rerun()
         except Exception:
@@ -741,56 +1101,64 @@ def init_banner():
 
 # ---------- App ----------
 
+# Demo links (Manager RO / Order / Kitchen): constant per PUBLIC_BASE_URL, so one
+# markdown element instead of three link_button widgets per rerun.
+_DEMO_URL = PUBLIC_BASE_URL or "https://<your-app>.streamlit.app"
+_DEMO_LINK_STYLE = (
+    "flex:1;text-align:center;padding:0.4rem 0.75rem;border:1px solid rgba(128,128,128,0.4);"
+    "border-radius:0.5rem;text-decoration:none"
+)
+_DEMO_HTML = '<div style="display:flex;gap:0.5rem;margin-bottom:1rem">' + "".join(
+    f'<a href="{escape(url)}" target="_blank" style="{_DEMO_LINK_STYLE}">{label}</a>'
+    for label, url in (
+        ("Manager (read-only)", f"{_DEMO_URL}/?view=manager&readonly=1"),
+        ("Order (take payment)", f"{_DEMO_URL}/?view=order"),
+        ("Kitchen (KDS)", f"{_DEMO_URL}/?view=kitchen"),
+    )
+) + "</div>"
+
+# View routes, keyed by the normalized (lowercase) name used by both ?view= and
+# the sidebar picker; every handler takes the loaded menu. Order = sidebar order.
+_VIEWS: Dict[str, Callable[[Dict[str, Any]], None]] = {
+    "order": place_order_ui,
+    "kitchen": lambda menu: kitchen_ui(),
+    "manager": lambda menu: manager_ui(),
+    "admin": lambda menu: admin_ui(),
+}
+
+
 def main():
     st.set_page_config(page_title=APP_NAME, page_icon="🍕", layout="wide")
     st.title(APP_NAME)
     st.caption("Single-file POS · Streamlit")
-    st.caption(f"Stripe ready: {bool(stripe.api_key)} · key starts with: {(stripe.api_key or '')[:7]}")
 
     # Demo buttons (Manager RO / Order / Kitchen)
-    c1, c2, c3 = st.columns(3)
-    app_url = PUBLIC_BASE_URL or "https://<your-app>.streamlit.app"
-    try:
-        c1.link_button("Manager (read-only)", f"{app_url}/?view=manager&readonly=1", use_container_width=True, key="demo_mgr_ro")
-        c2.link_button("Order (take payment)", f"{app_url}/?view=order", use_container_width=True, key="demo_order")
-        c3.link_button("Kitchen (KDS)", f"{app_url}/?view=kitchen", use_container_width=True, key="demo_kitchen")
-    except Exception:
-        st.markdown(f"[Manager (read-only)]({app_url}/?view=manager&readonly=1) · [Order]({app_url}/?view=order) · [Kitchen (KDS)]({app_url}/?view=kitchen)")
+    st.markdown(_DEMO_HTML, unsafe_allow_html=True)
 
-    init_state()
     init_db()
     menu = load_menu()
-    init_banner()
+    if "_inited" not in st.session_state:
+        # Seed state and handle a Stripe return once per browser session.
+        # The flag goes first because init_banner() ends with st.rerun().
+        st.session_state["_inited"] = True
+        init_state()
+        init_banner()
 
     # Route via query param: ?view=manager|kitchen|order|admin (&readonly=1)
-    def _qp1(name):
-        v = st.query_params.get(name)
-        if isinstance(v, list):
-            return v[0] if v else None
-        return v
-    view = (_qp1("view") or "").lower()
-    if view in {"manager","kitchen","order","admin"}:
-        if view == "manager":
-            manager_ui(); return
-        if view == "kitchen":
-            kitchen_ui(); return
-        if view == "order":
-            place_order_ui(menu); return
-        if view == "admin":
-            admin_ui(); return
-
-    tabs = st.tabs(["Order", "Kitchen", "Manager", "Admin"])
-    with tabs[0]:
-        place_order_ui(menu)
-    with tabs[1]:
-        kitchen_ui()
-    with tabs[2]:
-        manager_ui()
-    with tabs[3]:
-        admin_ui()
-
-    st.markdown("---")
-    st.caption("Tip: Set PUBLIC_BASE_URL to your deployed https URL for Stripe returns.")
+    qp = dict(st.query_params)  # one read of the proxy per rerun
+    raw_view = _qp1(qp, "view")
+    view = raw_view.lower() if raw_view else ""
+    handler = _VIEWS.get(view)
+    if handler is None:
+        # st.tabs would build all four views every rerun; render only the chosen one.
+        view = st.sidebar.radio("View", list(_VIEWS), format_func=str.capitalize, key="active_view")
+        handler = _VIEWS[view]
+        st.sidebar.caption("Tip: Set PUBLIC_BASE_URL to your deployed https URL for Stripe returns.")
+
+    # Key diagnostics are only useful to whoever is configuring Stripe
+    if view == "admin" or st.session_state.get("debug"):
+        st.caption(f"Stripe ready: {stripe_ready()} · key starts with: {STRIPE_SECRET_KEY[:7]}")
+    handler(menu)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+# db.py
+# Shared SQLite access for the Streamlit app and the webhook (no Streamlit imports here)
+# - WAL: many readers alongside one writer
+# - One writer connection behind a lock, BEGIN IMMEDIATE per transaction
+# - A small pool of read-only connections
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+WRITER_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+"""
+SESSION_PRAGMAS = """
+PRAGMA busy_timeout=5000;
+PRAGMA temp_store=memory;
+PRAGMA cache_size=-20000;
+PRAGMA mmap_size=268435456;
+PRAGMA foreign_keys=ON;
+"""
+
+
+class Database:
+    """One locked writer plus `readers` read-only connections to the same file.
+
+    The writer is opened first (mode=rwc) so the file exists before the
+    read-only connections open. A process that only writes can pass readers=0.
+    """
+
+    def __init__(self, path: str, readers: int = 5):
+        self.uri = Path(path).resolve().as_uri()
+        self._writer = self._connect("rwc")
+        self._write_lock = threading.Lock()
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect("ro"))
+
+    def _connect(self, mode: str) -> sqlite3.Connection:
+        # Connections live for the whole process, so a bigger statement cache keeps every
+        # fixed SQL text in both apps prepared
+        con = sqlite3.connect(
+            f"{self.uri}?mode={mode}", uri=True, check_same_thread=False,
+            isolation_level=None, cached_statements=256,
+        )
+        if mode != "ro":
+            con.executescript(WRITER_PRAGMAS)
+        con.executescript(SESSION_PRAGMAS)
+        return con
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        con = self._readers.get()
+        try:
+            yield con
+        finally:
+            self._readers.put(con)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Serialized write transaction; BEGIN IMMEDIATE takes the lock up front."""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
@@ -0,0 +1,33 @@
+# stripe_signature.py
+# Stripe-Signature header check for webhook.py (stdlib only, so it imports without FastAPI/DB)
+
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+SIGNATURE_TOLERANCE = 300  # seconds, same default as stripe.Webhook.construct_event
+
+
+def verify_signature(
+    payload: bytes, sig_header: Optional[str], secret: str,
+    tolerance: int = SIGNATURE_TOLERANCE, now: Optional[float] = None,
+) -> bool:
+    """HMAC-SHA256 of "<t>.<payload>" against every v1 in the header, t within tolerance."""
+    timestamp, signatures = None, []
+    for part in (sig_header or "").split(","):
+        key, _, value = part.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    if not timestamp or not signatures:
+        return False
+    try:
+        if abs((time.time() if now is None else now) - int(timestamp)) > tolerance:
+            return False
+    except ValueError:
+        return False
+    expected = hmac.new(secret.encode(), timestamp.encode() + b"." + payload, hashlib.sha256).hexdigest().encode()
+    # Compare bytes: compare_digest rejects non-ASCII str, and the header is attacker-controlled
+    return any(hmac.compare_digest(expected, sig.encode("utf-8", "surrogateescape")) for sig in signatures)
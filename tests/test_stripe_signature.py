@@ -0,0 +1,65 @@
+import hashlib
+import hmac
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from stripe_signature import SIGNATURE_TOLERANCE, verify_signature
+
+SECRET = "whsec_test"
+PAYLOAD = b'{"id": "evt_1", "type": "checkout.session.completed"}'
+NOW = 1_700_000_000
+
+
+def _sign(payload: bytes, t: int, secret: str = SECRET) -> str:
+    return hmac.new(secret.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+
+
+def test_valid_signature():
+    header = f"t={NOW},v1={_sign(PAYLOAD, NOW)}"
+    assert verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_wrong_secret():
+    header = f"t={NOW},v1={_sign(PAYLOAD, NOW, 'whsec_other')}"
+    assert not verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_tampered_payload():
+    header = f"t={NOW},v1={_sign(PAYLOAD, NOW)}"
+    assert not verify_signature(PAYLOAD + b" ", header, SECRET, now=NOW)
+
+
+def test_stale_timestamp():
+    t = NOW - SIGNATURE_TOLERANCE - 1
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    assert not verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_timestamp_within_tolerance():
+    t = NOW - SIGNATURE_TOLERANCE + 1
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    assert verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_multiple_v1_any_match():
+    # Stripe sends one v1 per active secret during rotation; v0 is ignored
+    header = f"t={NOW},v1={'0' * 64},v1={_sign(PAYLOAD, NOW)},v0=deadbeef"
+    assert verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_multiple_v1_none_match():
+    header = f"t={NOW},v1={'0' * 64},v1={'f' * 64}"
+    assert not verify_signature(PAYLOAD, header, SECRET, now=NOW)
+
+
+def test_malformed_headers():
+    sig = _sign(PAYLOAD, NOW)
+    for header in (None, "", "garbage", f"v1={sig}", f"t={NOW}", f"t=abc,v1={sig}", f"t={NOW},v0={sig}", ",,="):
+        assert not verify_signature(PAYLOAD, header, SECRET, now=NOW), header
+
+
+def test_non_ascii_signature_is_rejected_not_raised():
+    header = f"t={NOW},v1=ééé"
+    assert not verify_signature(PAYLOAD, header, SECRET, now=NOW)
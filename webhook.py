@@ -1,18 +1,36 @@
 # webhook.py
+import json
 import os
 import sqlite3
 from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import PlainTextResponse
-import stripe
 
-DB_FILE = "orders.db"  # same DB your Streamlit app uses
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "")
+from db import Database
+from stripe_signature import verify_signature
+
+# same DB your Streamlit app uses (absolute, so it doesn't depend on the cwd)
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "orders.db")
 WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 
 app = FastAPI()
 
-def get_conn():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+db = Database(DB_FILE, readers=0)  # write-only: one long-lived WAL connection
+with db.writer() as con:
+    # Stripe redelivers events; remember which ones were already applied
+    con.execute("CREATE TABLE IF NOT EXISTS processed_events (id TEXT PRIMARY KEY)")
+
+def _apply_paid(event_id: str, order_id: int):
+    # Blocking (lock wait + commit); the handler runs it in the threadpool, off the event loop
+    with db.writer() as con:
+        seen = con.execute(
+            "INSERT OR IGNORE INTO processed_events (id) VALUES (?)", (event_id,)
+        ).rowcount == 0
+        if not seen:  # first delivery only; a redelivery commits nothing
+            con.execute(
+                "UPDATE orders SET paid=1, payment_method='Card' WHERE id=?",
+                (order_id,)
+            )
 
 @app.post("/stripe/webhook")
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
@@ -21,13 +39,11 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
     if not WEBHOOK_SECRET:
         raise HTTPException(status_code=500, detail="Webhook secret not set")
 
-    try:
-        event = stripe.Webhook.construct_event(
-            payload=payload, sig_header=stripe_signature, secret=WEBHOOK_SECRET
-        )
-    except stripe.error.SignatureVerificationError:
+    if not verify_signature(payload, stripe_signature, WEBHOOK_SECRET):
         raise HTTPException(status_code=400, detail="Invalid signature")
-    except Exception:
+    try:
+        event = json.loads(payload)  # only parsed once the signature checks out
+    except ValueError:
         raise HTTPException(status_code=400, detail="Invalid payload")
 
     # Mark order paid on successful checkout
@@ -35,13 +51,10 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         data = event["data"]["object"]
         order_id = (data.get("metadata") or {}).get("order_id")
         if order_id:
-            con = get_conn()
-            cur = con.cursor()
-            cur.execute(
-                "UPDATE orders SET paid=1, payment_method='Card' WHERE id=?",
-                (int(order_id),)
-            )
-            con.commit()
-            con.close()
+            # 200 only after the commit: on failure Stripe gets a 500 and redelivers
+            try:
+                await run_in_threadpool(_apply_paid, event["id"], int(order_id))
+            except sqlite3.Error:
+                raise HTTPException(status_code=500, detail="Could not record payment")
 
     return PlainTextResponse("ok", status_code=200)